@@ -26,8 +26,11 @@
 
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
 import os
 from pathlib import Path
+import re
+from typing import Iterator
 
 from sphinx.application import Sphinx
 from sphinx.util import logging
@@ -41,7 +44,50 @@ FILES = {
     # Added in Sphinx 5.0.0, scheduled to be removed in Sphinx 6
     'static/_sphinx_javascript_frameworks_compat.js': 'static/sphinx_javascript_frameworks_compat.js',  # noqa: E501
 }
-REWRITE_EXTENSIONS = {'.html', '.js'}
+REWRITE_EXTENSIONS = ('.html', '.js')
+
+
+def _find_rewrite_paths(dirpath: str | os.PathLike[str]) -> Iterator[str]:
+    # DirEntry caches the file type from the directory listing, so this
+    # avoids the extra stat() calls made by os.walk()
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _find_rewrite_paths(entry.path)
+            elif entry.name.endswith(REWRITE_EXTENSIONS):
+                yield entry.path
+
+
+def _get_rewrites() -> dict[bytes, bytes]:
+    rewrites = {old + '/': new + '/' for old, new in DIRS.items()}
+    for old, new in FILES.items():
+        rewrites[old] = new
+        # FILES paths may also be referenced with the original directory name
+        for old_dir, new_dir in DIRS.items():
+            if old.startswith(new_dir + '/'):
+                rewrites[old_dir + old[len(new_dir) :]] = new
+    # The replacements are pure ASCII, so operate on the raw UTF-8 bytes
+    # rather than decoding and reencoding each file
+    return {old.encode('UTF-8'): new.encode('UTF-8') for old, new in rewrites.items()}
+
+
+REWRITES = _get_rewrites()
+# Try longest strings first, so FILES paths win over their directory prefix
+REWRITE_PATTERN = re.compile(
+    b'|'.join(re.escape(old) for old in sorted(REWRITES, key=len, reverse=True))
+)
+
+
+def _rewrite_file(path: str) -> None:
+    with open(path, 'rb') as fh:
+        contents = fh.read()
+    # Skip files with nothing to rewrite, and rewrite the others in a
+    # single pass
+    if REWRITE_PATTERN.search(contents) is None:
+        return
+    contents = REWRITE_PATTERN.sub(lambda m: REWRITES[m.group()], contents)
+    with open(path, 'wb') as fh:
+        fh.write(contents)
 
 
 def remove_path_underscores(app: Sphinx, exception: Exception | None) -> None:
@@ -52,27 +98,29 @@ def remove_path_underscores(app: Sphinx, exception: Exception | None) -> None:
     logger.info(bold('fixing pathnames... '), nonl=True)
     # Rewrite references in HTML/JS files
     outdir = Path(app.outdir)
-    for dirpath, _, filenames in os.walk(outdir):
-        for filename in filenames:
-            path = Path(dirpath) / filename
-            if path.suffix in REWRITE_EXTENSIONS:
-                with path.open(encoding='utf-8') as fh:
-                    contents = fh.read()
-                for old, new in DIRS.items():
-                    contents = contents.replace(old + '/', new + '/')
-                for old, new in FILES.items():
-                    contents = contents.replace(old, new)
-                with path.open('w', encoding='utf-8') as fh:
-                    fh.write(contents)
+    # Files are independent and the work is mostly I/O, so use threads
+    with ThreadPoolExecutor() as executor:
+        # consume the iterator to propagate exceptions
+        for _ in executor.map(_rewrite_file, _find_rewrite_paths(outdir)):
+            pass
     # Move directory contents
     for old, new in DIRS.items():
         olddir = outdir / old
         newdir = outdir / new
-        newdir.mkdir(exist_ok=True)
         if olddir.is_dir():
-            for oldfile in olddir.iterdir():
-                oldfile.rename(newdir / oldfile.name)
-            olddir.rmdir()
+            try:
+                # Fast path: rename the whole directory at once
+                olddir.rename(newdir)
+            except OSError:
+                # newdir already exists and isn't empty; merge into it
+                oldfiles = list(olddir.iterdir())
+                newfiles = [newdir / oldfile.name for oldfile in oldfiles]
+                with ThreadPoolExecutor() as executor:
+                    for _ in executor.map(Path.rename, oldfiles, newfiles):
+                        pass
+                olddir.rmdir()
+        else:
+            newdir.mkdir(exist_ok=True)
     # Move files
     for old, new in FILES.items():
         oldfile = outdir / old
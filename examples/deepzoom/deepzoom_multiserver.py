@@ -23,17 +23,27 @@ from __future__ import annotations
 
 from argparse import ArgumentParser
 import base64
-from collections import OrderedDict
 from collections.abc import Callable
+from datetime import datetime, timezone
+from functools import lru_cache
 from io import BytesIO
 import os
 from pathlib import Path, PurePath
+import struct
 from threading import Lock
+import time
 from typing import TYPE_CHECKING, Any, Literal
 import zlib
 
-from PIL import Image, ImageCms
-from flask import Flask, Response, abort, make_response, render_template, url_for
+from PIL import Image, ImageCms, features
+from flask import Flask, Response, abort, render_template, request, url_for
+
+try:
+    # Optional faster JPEG encoder
+    import numpy as np  # type: ignore[import-not-found,unused-ignore]
+    import simplejpeg  # type: ignore[import-not-found,import-untyped,unused-ignore]
+except ImportError:
+    simplejpeg = None
 
 if TYPE_CHECKING:
     # Python 3.10+
@@ -69,6 +79,31 @@ SRGB_PROFILE_BYTES = zlib.decompress(
 )
 SRGB_PROFILE = ImageCms.getOpenProfile(BytesIO(SRGB_PROFILE_BYTES))
 
+
+def _jpeg_icc_segments(profile: bytes) -> bytes:
+    # Split the profile into APP2 marker segments, as Pillow would
+    chunk_size = 65519
+    chunks = [profile[i : i + chunk_size] for i in range(0, len(profile), chunk_size)]
+    return b''.join(
+        b'\xff\xe2'
+        + struct.pack('>H', 16 + len(chunk))
+        + b'ICC_PROFILE\0'
+        + bytes((i + 1, len(chunks)))
+        + chunk
+        for i, chunk in enumerate(chunks)
+    )
+
+
+def _png_icc_chunk(profile: bytes) -> bytes:
+    # Build a compressed iCCP chunk, as Pillow would
+    data = b'iCCP' + b'ICC Profile\0\0' + zlib.compress(profile)
+    return struct.pack('>I', len(data) - 4) + data + struct.pack('>I', zlib.crc32(data))
+
+
+# Preformatted for splicing directly into JPEG and PNG tiles
+SRGB_PROFILE_JPEG_SEGMENTS = _jpeg_icc_segments(SRGB_PROFILE_BYTES)
+SRGB_PROFILE_PNG_CHUNK = _png_icc_chunk(SRGB_PROFILE_BYTES)
+
 if TYPE_CHECKING:
     ColorMode: TypeAlias = Literal[
         'default',
@@ -85,12 +120,16 @@ if TYPE_CHECKING:
 class DeepZoomMultiServer(Flask):
     basedir: Path
     cache: _SlideCache
+    directory_cache: _DirectoryCache
 
 
 class AnnotatedDeepZoomGenerator(DeepZoomGenerator):
     filename: str
     mpp: float
-    transform: Transform
+    transform: Transform | None
+    dzi: bytes
+    mtime_ns: int
+    last_used: float
 
 
 def create_app(
@@ -108,6 +147,7 @@ def create_app(
         DEEPZOOM_OVERLAP=1,
         DEEPZOOM_LIMIT_BOUNDS=True,
         DEEPZOOM_TILE_QUALITY=75,
+        DEEPZOOM_PNG_COMPRESS_LEVEL=1,
         DEEPZOOM_COLOR_MODE='default',
     )
     app.config.from_envvar('DEEPZOOM_MULTISERVER_SETTINGS', silent=True)
@@ -116,6 +156,15 @@ def create_app(
     if config is not None:
         app.config.from_mapping(config)
 
+    # JPEG encoding dominates tile rendering time; it's much slower without
+    # libjpeg-turbo's SIMD code
+    if app.config['DEEPZOOM_FORMAT'] == 'jpeg' and not features.check_feature(
+        'libjpeg_turbo'
+    ):
+        app.logger.warning(
+            'Pillow was built without libjpeg-turbo; JPEG tiles will be slow'
+        )
+
     # Set up cache
     app.basedir = Path(app.config['SLIDE_DIR']).resolve(strict=True)
     config_map = {
@@ -128,13 +177,39 @@ def create_app(
         app.config['SLIDE_CACHE_SIZE'],
         app.config['SLIDE_TILE_CACHE_MB'],
         opts,
+        app.config['DEEPZOOM_FORMAT'],
         app.config['DEEPZOOM_COLOR_MODE'],
     )
+    app.directory_cache = _DirectoryCache(app.basedir)
+
+    # Responses depend on the rendering settings as well as the slide file
+    settings_tag = '%08x' % zlib.crc32(
+        repr(
+            [
+                app.config[k]
+                for k in (
+                    'DEEPZOOM_FORMAT',
+                    'DEEPZOOM_TILE_SIZE',
+                    'DEEPZOOM_OVERLAP',
+                    'DEEPZOOM_LIMIT_BOUNDS',
+                    'DEEPZOOM_TILE_QUALITY',
+                    'DEEPZOOM_PNG_COMPRESS_LEVEL',
+                    'DEEPZOOM_COLOR_MODE',
+                )
+            ]
+        ).encode()
+    )
 
     # Helper functions
+    # resolve() costs a syscall per path component, and slides aren't
+    # expected to move while the server is running.  Failures aren't cached.
+    @lru_cache(maxsize=1024)
+    def resolve_path(user_path: PurePath) -> Path:
+        return (app.basedir / user_path).resolve(strict=True)
+
     def get_slide(user_path: PurePath) -> AnnotatedDeepZoomGenerator:
         try:
-            path = (app.basedir / user_path).resolve(strict=True)
+            path = resolve_path(user_path)
         except OSError:
             # Does not exist
             abort(404)
@@ -145,13 +220,26 @@ def create_app(
             slide = app.cache.get(path)
             slide.filename = path.name
             return slide
-        except OpenSlideError:
+        except (OpenSlideError, OSError):
+            # OSError if the slide was removed after its path was cached
             abort(404)
 
+    def get_etag(slide: AnnotatedDeepZoomGenerator) -> str:
+        return f'{slide.mtime_ns:x}-{settings_tag}'
+
+    def set_cache_headers(
+        resp: Response, slide: AnnotatedDeepZoomGenerator, etag: str
+    ) -> Response:
+        resp.set_etag(etag)
+        resp.last_modified = datetime.fromtimestamp(slide.mtime_ns / 1e9, timezone.utc)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = 86400
+        return resp
+
     # Set up routes
     @app.route('/')
     def index() -> str:
-        return render_template('files.html', root_dir=_Directory(app.basedir))
+        return render_template('files.html', root_dir=app.directory_cache.get())
 
     @app.route('/<path:path>')
     def slide(path: str) -> str:
@@ -167,10 +255,11 @@ def create_app(
     @app.route('/<path:path>.dzi')
     def dzi(path: str) -> Response:
         slide = get_slide(PurePath(path))
-        format = app.config['DEEPZOOM_FORMAT']
-        resp = make_response(slide.get_dzi(format))
-        resp.mimetype = 'application/xml'
-        return resp
+        etag = get_etag(slide)
+        if etag in request.if_none_match:
+            return set_cache_headers(Response(status=304), slide, etag)
+        resp = Response(slide.dzi, mimetype='application/xml')
+        return set_cache_headers(resp, slide, etag)
 
     @app.route('/<path:path>_files/<int:level>/<int:col>_<int:row>.<format>')
     def tile(path: str, level: int, col: int, row: int, format: str) -> Response:
@@ -179,24 +268,84 @@ def create_app(
         if format != 'jpeg' and format != 'png':
             # Not supported by Deep Zoom
             abort(404)
-        try:
-            tile = slide.get_tile(level, (col, row))
-        except ValueError:
-            # Invalid level or coordinates
+        # Check level and coordinates before doing any work
+        level_tiles = slide.level_tiles
+        if level >= len(level_tiles):
             abort(404)
-        slide.transform(tile)
-        buf = BytesIO()
+        cols, rows = level_tiles[level]
+        if col >= cols or row >= rows:
+            abort(404)
+        etag = get_etag(slide)
+        if etag in request.if_none_match:
+            return set_cache_headers(Response(status=304), slide, etag)
+        tile = slide.get_tile(level, (col, row))
+        if slide.transform is not None:
+            slide.transform(tile)
+        resp = Response(
+            encode_tile(
+                tile,
+                format,
+                app.config['DEEPZOOM_TILE_QUALITY'],
+                app.config['DEEPZOOM_PNG_COMPRESS_LEVEL'],
+            ),
+            mimetype='image/%s' % format,
+        )
+        return set_cache_headers(resp, slide, etag)
+
+    return app
+
+
+def encode_tile(
+    tile: Image.Image, format: str, quality: int, png_compress_level: int
+) -> bytes:
+    buf = BytesIO()
+    if format == 'jpeg':
+        profile = tile.info.get('icc_profile')
+        if profile is None or profile is SRGB_PROFILE_BYTES:
+            if simplejpeg is not None:
+                # simplejpeg encodes directly from the pixel array with less
+                # overhead than Pillow
+                data: bytes = simplejpeg.encode_jpeg(
+                    np.asarray(tile), quality=quality, colorsubsampling='420'
+                )
+            else:
+                tile.save(buf, 'jpeg', quality=quality)
+                data = buf.getvalue()
+            if profile is not None:
+                # Splice in the preformatted sRGB profile rather than having
+                # the encoder reformat it for every tile
+                data = _splice_jpeg_segments(data, SRGB_PROFILE_JPEG_SEGMENTS)
+            return data
+        tile.save(buf, 'jpeg', quality=quality, icc_profile=profile)
+    else:
+        profile = tile.info.get('icc_profile')
+        srgb = profile is SRGB_PROFILE_BYTES
+        # Deflate dominates PNG encoding time, and low compression levels
+        # are much faster for a modest increase in size
         tile.save(
             buf,
-            format,
-            quality=app.config['DEEPZOOM_TILE_QUALITY'],
-            icc_profile=tile.info.get('icc_profile'),
+            'png',
+            compress_level=png_compress_level,
+            icc_profile=None if srgb else profile,
         )
-        resp = make_response(buf.getvalue())
-        resp.mimetype = 'image/%s' % format
-        return resp
+        if srgb:
+            # Splice in the precompressed sRGB profile
+            return _splice_png_chunk(buf.getvalue(), SRGB_PROFILE_PNG_CHUNK)
+    return buf.getvalue()
 
-    return app
+
+def _splice_jpeg_segments(data: bytes, segments: bytes) -> bytes:
+    # Insert after the SOI marker and the JFIF APP0 segment, if any
+    pos = 2
+    if data[2:4] == b'\xff\xe0':
+        pos += 2 + int.from_bytes(data[4:6], 'big')
+    return data[:pos] + segments + data[pos:]
+
+
+def _splice_png_chunk(data: bytes, chunk: bytes) -> bytes:
+    # Insert after the signature and the IHDR chunk, which must come first
+    pos = 8 + 12 + int.from_bytes(data[8:12], 'big')
+    return data[:pos] + chunk + data[pos:]
 
 
 class _SlideCache:
@@ -205,13 +354,17 @@ class _SlideCache:
         cache_size: int,
         tile_cache_mb: int,
         dz_opts: dict[str, Any],
+        dz_format: str,
         color_mode: ColorMode,
     ):
         self.cache_size = cache_size
         self.dz_opts = dz_opts
+        self.dz_format = dz_format
         self.color_mode = color_mode
         self._lock = Lock()
-        self._cache: OrderedDict[Path, AnnotatedDeepZoomGenerator] = OrderedDict()
+        # Copy-on-write: readers use the current snapshot without locking,
+        # and writers replace it under the lock rather than mutating it
+        self._cache: dict[Path, AnnotatedDeepZoomGenerator] = {}
         # Share a single tile cache among all slide handles, if supported
         try:
             self._tile_cache: OpenSlideCache | None = OpenSlideCache(
@@ -221,13 +374,13 @@ class _SlideCache:
             self._tile_cache = None
 
     def get(self, path: Path) -> AnnotatedDeepZoomGenerator:
-        with self._lock:
-            if path in self._cache:
-                # Move to end of LRU
-                slide = self._cache.pop(path)
-                self._cache[path] = slide
-                return slide
+        slide = self._cache.get(path)
+        if slide is not None:
+            slide.last_used = time.monotonic()
+            return slide
 
+        # Stat before opening, so a concurrent change can't be missed
+        mtime_ns = path.stat().st_mtime_ns
         osr = OpenSlide(path)
         if self._tile_cache is not None:
             osr.set_cache(self._tile_cache)
@@ -239,26 +392,33 @@ class _SlideCache:
         except (KeyError, ValueError):
             slide.mpp = 0
         slide.transform = self._get_transform(osr)
+        slide.dzi = slide.get_dzi(self.dz_format).encode('UTF-8')
+        slide.mtime_ns = mtime_ns
+        slide.last_used = time.monotonic()
 
         with self._lock:
             if path not in self._cache:
-                if len(self._cache) == self.cache_size:
-                    self._cache.popitem(last=False)
-                self._cache[path] = slide
+                cache = dict(self._cache)
+                if len(cache) == self.cache_size:
+                    del cache[min(cache, key=lambda p: cache[p].last_used)]
+                cache[path] = slide
+                self._cache = cache
         return slide
 
-    def _get_transform(self, image: OpenSlide) -> Transform:
-        if image.color_profile is None:
-            return lambda img: None
+    def _get_transform(self, image: OpenSlide) -> Transform | None:
+        # None if tiles can be served as read
+        profile = image.color_profile
+        if profile is None:
+            return None
         mode = self.color_mode
         if mode == 'ignore':
             # drop ICC profile from tiles
             return lambda img: img.info.pop('icc_profile')
         elif mode == 'embed':
             # embed ICC profile in tiles
-            return lambda img: None
+            return None
         elif mode == 'default':
-            intent = ImageCms.Intent(ImageCms.getDefaultIntent(image.color_profile))
+            intent = ImageCms.Intent(ImageCms.getDefaultIntent(profile))
         elif mode == 'absolute-colorimetric':
             intent = ImageCms.Intent.ABSOLUTE_COLORIMETRIC
         elif mode == 'relative-colorimetric':
@@ -269,14 +429,7 @@ class _SlideCache:
             intent = ImageCms.Intent.SATURATION
         else:
             raise ValueError(f'Unknown color mode {mode}')
-        transform = ImageCms.buildTransform(
-            image.color_profile,
-            SRGB_PROFILE,
-            'RGB',
-            'RGB',
-            intent,
-            ImageCms.Flags(0),
-        )
+        transform = _get_srgb_transform(profile.tobytes(), intent)
 
         def xfrm(img: Image.Image) -> None:
             ImageCms.applyTransform(img, transform, True)
@@ -288,20 +441,113 @@ class _SlideCache:
         return xfrm
 
 
+# Slides from the same scanner usually share an ICC profile, so share the
+# transforms too rather than building a new one for each slide
+@lru_cache(maxsize=32)
+def _get_srgb_transform(
+    profile: bytes, intent: ImageCms.Intent
+) -> ImageCms.ImageCmsTransform:
+    return ImageCms.buildTransform(
+        ImageCms.getOpenProfile(BytesIO(profile)),
+        SRGB_PROFILE,
+        'RGB',
+        'RGB',
+        intent,
+        ImageCms.Flags(0),
+    )
+
+
+class _DirectoryCache:
+    def __init__(self, basedir: Path):
+        self.basedir = basedir
+        self._lock = Lock()
+        self._root: _Directory | None = None
+        self._stamps: dict[str, tuple[int, int]] = {}
+
+    def get(self) -> _Directory:
+        with self._lock:
+            if self._root is None or not self._is_current():
+                stamps: dict[str, tuple[int, int]] = {}
+                self._root = _Directory(self.basedir, stamps=stamps)
+                self._stamps = stamps
+            return self._root
+
+    def _is_current(self) -> bool:
+        # Adding, removing, or renaming an entry updates the mtime of its
+        # parent directory.  Rejected files are also tracked, so a slide
+        # that was still being written is probed again once it changes.
+        try:
+            return all(
+                _stat_stamp(path) == stamp for path, stamp in self._stamps.items()
+            )
+        except OSError:
+            return False
+
+
+def _stat_stamp(path: str) -> tuple[int, int]:
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
 class _Directory:
     _DEFAULT_RELPATH = PurePath('.')
+    # detect_format() opens the file, so skip files that are known not to
+    # be slides, such as MIRAX and VMS sidecar files.  Anything else,
+    # including files with no extension (e.g. DICOM), is probed.
+    _NON_SLIDE_EXTENSIONS = frozenset(
+        {
+            '.csv',
+            '.dat',
+            '.gz',
+            '.htm',
+            '.html',
+            '.ini',
+            '.json',
+            '.log',
+            '.md',
+            '.pdf',
+            '.txt',
+            '.xml',
+            '.zip',
+        }
+    )
 
-    def __init__(self, basedir: Path, relpath: PurePath = _DEFAULT_RELPATH):
+    def __init__(
+        self,
+        basedir: Path,
+        relpath: PurePath = _DEFAULT_RELPATH,
+        stamps: dict[str, tuple[int, int]] | None = None,
+    ):
         self.name = relpath.name
         self.children: list[_Directory | _SlideFile] = []
-        for cur_path in sorted((basedir / relpath).iterdir()):
-            cur_relpath = relpath / cur_path.name
-            if cur_path.is_dir():
-                cur_dir = _Directory(basedir, cur_relpath)
+        dirpath = basedir / relpath
+        if stamps is not None:
+            # Record the mtime before listing, so concurrent changes are
+            # picked up on the next check
+            stamps[str(dirpath)] = _stat_stamp(str(dirpath))
+        # scandir() entries usually know their type without another stat()
+        with os.scandir(dirpath) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            cur_relpath = relpath / entry.name
+            if entry.is_dir():
+                cur_dir = _Directory(basedir, cur_relpath, stamps)
                 if cur_dir.children:
                     self.children.append(cur_dir)
-            elif OpenSlide.detect_format(cur_path):
-                self.children.append(_SlideFile(cur_relpath))
+            else:
+                ext = os.path.splitext(entry.name)[1].lower()
+                if ext in self._NON_SLIDE_EXTENSIONS:
+                    continue
+                try:
+                    # Stat before probing, like the directory mtime above
+                    stamp = _stat_stamp(entry.path)
+                except OSError:
+                    # Removed since listing
+                    continue
+                if OpenSlide.detect_format(entry.path):
+                    self.children.append(_SlideFile(cur_relpath))
+                elif stamps is not None:
+                    stamps[entry.path] = stamp
 
 
 class _SlideFile:
@@ -389,6 +635,14 @@ if __name__ == '__main__':
         type=int,
         help='JPEG compression quality [75]',
     )
+    parser.add_argument(
+        '--png-level',
+        metavar='LEVEL',
+        dest='DEEPZOOM_PNG_COMPRESS_LEVEL',
+        type=int,
+        choices=range(10),
+        help='PNG compression level [1]',
+    )
     parser.add_argument(
         '-s',
         '--size',
@@ -406,13 +660,9 @@ if __name__ == '__main__':
     )
 
     args = parser.parse_args()
-    config = {}
     config_file = args.config
     # Set only those settings specified on the command line
-    for k in dir(args):
-        v = getattr(args, k)
-        if not k.startswith('_') and v is not None:
-            config[k] = v
+    config = {k: v for k, v in vars(args).items() if v is not None}
     app = create_app(config, config_file)
 
     app.run(host=args.host, port=args.port, threaded=True)
@@ -23,17 +23,37 @@ from __future__ import annotations
 
 from argparse import ArgumentParser
 import base64
+from collections import OrderedDict
 from collections.abc import Callable
+from datetime import datetime, timezone
 from io import BytesIO
 import os
 from pathlib import Path
 import re
+import struct
+from threading import Lock
 from typing import TYPE_CHECKING, Any, Literal, Mapping
 from unicodedata import normalize
 import zlib
 
-from PIL import Image, ImageCms
-from flask import Flask, Response, abort, make_response, render_template, url_for
+from PIL import Image, ImageCms, features
+from flask import (
+    Flask,
+    Response,
+    abort,
+    render_template,
+    request,
+    send_from_directory,
+    url_for,
+)
+from werkzeug.exceptions import NotFound
+
+try:
+    # Optional faster JPEG encoder
+    import numpy as np  # type: ignore[import-not-found,unused-ignore]
+    import simplejpeg  # type: ignore[import-not-found,import-untyped,unused-ignore]
+except ImportError:
+    simplejpeg = None
 
 if TYPE_CHECKING:
     # Python 3.10+
@@ -71,6 +91,24 @@ SRGB_PROFILE_BYTES = zlib.decompress(
 )
 SRGB_PROFILE = ImageCms.getOpenProfile(BytesIO(SRGB_PROFILE_BYTES))
 
+
+def _jpeg_icc_segments(profile: bytes) -> bytes:
+    # Split the profile into APP2 marker segments, as Pillow would
+    chunk_size = 65519
+    chunks = [profile[i : i + chunk_size] for i in range(0, len(profile), chunk_size)]
+    return b''.join(
+        b'\xff\xe2'
+        + struct.pack('>H', 16 + len(chunk))
+        + b'ICC_PROFILE\0'
+        + bytes((i + 1, len(chunks)))
+        + chunk
+        for i, chunk in enumerate(chunks)
+    )
+
+
+# Preformatted for splicing directly into JPEG tiles
+SRGB_PROFILE_JPEG_SEGMENTS = _jpeg_icc_segments(SRGB_PROFILE_BYTES)
+
 if TYPE_CHECKING:
     ColorMode: TypeAlias = Literal[
         'default',
@@ -82,14 +120,18 @@ if TYPE_CHECKING:
         'ignore',
     ]
     Transform: TypeAlias = Callable[[Image.Image], None]
+    TileKey: TypeAlias = tuple[str, int, int, int, str]
 
 
 class DeepZoomServer(Flask):
     slides: dict[str, DeepZoomGenerator]
-    transforms: dict[str, Transform]
+    dzis: dict[str, bytes]
+    transforms: dict[str, Transform | None]
     slide_properties: Mapping[str, str]
-    associated_images: list[str]
+    # name -> slug
+    associated_images: dict[str, str]
     slide_mpp: float
+    tile_cache: _TileCache
 
 
 def create_app(
@@ -106,6 +148,10 @@ def create_app(
         DEEPZOOM_LIMIT_BOUNDS=True,
         DEEPZOOM_TILE_QUALITY=75,
         DEEPZOOM_COLOR_MODE='default',
+        DEEPZOOM_TILE_CACHE_MB=64,
+        # Output of deepzoom_tile.py --viewer for the same slide, rendered
+        # with the same format, tile size, overlap, and bounds settings
+        DEEPZOOM_STATIC_ROOT=None,
     )
     app.config.from_envvar('DEEPZOOM_TILER_SETTINGS', silent=True)
     if config_file is not None:
@@ -113,6 +159,15 @@ def create_app(
     if config is not None:
         app.config.from_mapping(config)
 
+    # JPEG encoding dominates tile rendering time; it's much slower without
+    # libjpeg-turbo's SIMD code
+    if app.config['DEEPZOOM_FORMAT'] == 'jpeg' and not features.check_feature(
+        'libjpeg_turbo'
+    ):
+        app.logger.warning(
+            'Pillow was built without libjpeg-turbo; JPEG tiles will be slow'
+        )
+
     # Open slide
     if app.config['DEEPZOOM_SLIDE'] is None:
         raise ValueError('No slide file specified')
@@ -123,34 +178,98 @@ def create_app(
         'DEEPZOOM_LIMIT_BOUNDS': 'limit_bounds',
     }
     opts = {v: app.config[k] for k, v in config_map.items()}
+    # Stat before opening, so a concurrent change can't be missed
+    slide_mtime_ns = slidefile.stat().st_mtime_ns
     slide = open_slide(slidefile)
-    app.slides = {SLIDE_NAME: DeepZoomGenerator(slide, **opts)}
+    dz = DeepZoomGenerator(slide, **opts)
+    app.slides = {SLIDE_NAME: dz}
     app.transforms = {
         SLIDE_NAME: get_transform(slide, app.config['DEEPZOOM_COLOR_MODE'])
     }
-    app.associated_images = []
+    app.dzis = {SLIDE_NAME: dz.get_dzi(app.config['DEEPZOOM_FORMAT']).encode('UTF-8')}
+    # Associated images are only read when first requested
+    app.associated_images = {name: slugify(name) for name in slide.associated_images}
+    associated_names = {slug: name for name, slug in app.associated_images.items()}
+    associated_lock = Lock()
     app.slide_properties = slide.properties
-    for name, image in slide.associated_images.items():
-        app.associated_images.append(name)
-        slug = slugify(name)
-        image_slide = ImageSlide(image)
-        app.slides[slug] = DeepZoomGenerator(image_slide, **opts)
-        app.transforms[slug] = get_transform(
-            image_slide, app.config['DEEPZOOM_COLOR_MODE']
-        )
     try:
         mpp_x = slide.properties[openslide.PROPERTY_NAME_MPP_X]
         mpp_y = slide.properties[openslide.PROPERTY_NAME_MPP_Y]
         app.slide_mpp = (float(mpp_x) + float(mpp_y)) / 2
     except (KeyError, ValueError):
         app.slide_mpp = 0
+    app.tile_cache = _TileCache(app.config['DEEPZOOM_TILE_CACHE_MB'] * 1024 * 1024)
+
+    # Pre-rendered tiles must line up with the DZIs we serve
+    static_root = app.config['DEEPZOOM_STATIC_ROOT']
+    if static_root is not None:
+        try:
+            static_dzi = (Path(static_root) / f'{SLIDE_NAME}.dzi').read_bytes()
+        except OSError:
+            static_dzi = None
+        if static_dzi != app.dzis[SLIDE_NAME]:
+            app.logger.warning(
+                'Ignoring %s: no %s.dzi matching the current tile settings',
+                static_root,
+                SLIDE_NAME,
+            )
+            static_root = None
+
+    # Responses depend on the rendering settings as well as the slide file
+    settings_tag = '%08x' % zlib.crc32(
+        repr(
+            [
+                app.config[k]
+                for k in (
+                    'DEEPZOOM_FORMAT',
+                    'DEEPZOOM_TILE_SIZE',
+                    'DEEPZOOM_OVERLAP',
+                    'DEEPZOOM_LIMIT_BOUNDS',
+                    'DEEPZOOM_TILE_QUALITY',
+                    'DEEPZOOM_COLOR_MODE',
+                )
+            ]
+        ).encode()
+    )
+    etag = f'{slide_mtime_ns:x}-{settings_tag}'
+    last_modified = datetime.fromtimestamp(slide_mtime_ns / 1e9, timezone.utc)
+
+    # Helper functions
+    def load_slug(slug: str) -> None:
+        if slug in app.slides:
+            return
+        try:
+            name = associated_names[slug]
+        except KeyError:
+            # Unknown slug
+            abort(404)
+        with associated_lock:
+            if slug in app.slides:
+                return
+            image_slide = ImageSlide(slide.associated_images[name])
+            image_dz = DeepZoomGenerator(image_slide, **opts)
+            app.transforms[slug] = get_transform(
+                image_slide, app.config['DEEPZOOM_COLOR_MODE']
+            )
+            dzi = image_dz.get_dzi(app.config['DEEPZOOM_FORMAT'])
+            app.dzis[slug] = dzi.encode('UTF-8')
+            # Publish last, so lock-free readers see a complete entry
+            app.slides[slug] = image_dz
+
+    def set_cache_headers(resp: Response) -> Response:
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
+        resp.cache_control.public = True
+        resp.cache_control.max_age = 86400
+        return resp
 
     # Set up routes
     @app.route('/')
     def index() -> str:
         slide_url = url_for('dzi', slug=SLIDE_NAME)
         associated_urls = {
-            name: url_for('dzi', slug=slugify(name)) for name in app.associated_images
+            name: url_for('dzi', slug=slug)
+            for name, slug in app.associated_images.items()
         }
         return render_template(
             'slide-multipane.html',
@@ -162,14 +281,11 @@ def create_app(
 
     @app.route('/<slug>.dzi')
     def dzi(slug: str) -> Response:
-        format = app.config['DEEPZOOM_FORMAT']
-        try:
-            resp = make_response(app.slides[slug].get_dzi(format))
-            resp.mimetype = 'application/xml'
-            return resp
-        except KeyError:
-            # Unknown slug
-            abort(404)
+        load_slug(slug)
+        dzi = app.dzis[slug]
+        if etag in request.if_none_match:
+            return set_cache_headers(Response(status=304))
+        return set_cache_headers(Response(dzi, mimetype='application/xml'))
 
     @app.route('/<slug>_files/<int:level>/<int:col>_<int:row>.<format>')
     def tile(slug: str, level: int, col: int, row: int, format: str) -> Response:
@@ -177,43 +293,118 @@ def create_app(
         if format != 'jpeg' and format != 'png':
             # Not supported by Deep Zoom
             abort(404)
-        try:
-            tile = app.slides[slug].get_tile(level, (col, row))
-        except KeyError:
-            # Unknown slug
+        load_slug(slug)
+        # Check level and coordinates before doing any work
+        level_tiles = app.slides[slug].level_tiles
+        if level >= len(level_tiles):
             abort(404)
-        except ValueError:
-            # Invalid level or coordinates
+        cols, rows = level_tiles[level]
+        if col >= cols or row >= rows:
             abort(404)
-        app.transforms[slug](tile)
-        buf = BytesIO()
-        tile.save(
-            buf,
-            format,
-            quality=app.config['DEEPZOOM_TILE_QUALITY'],
-            icc_profile=tile.info.get('icc_profile'),
-        )
-        resp = make_response(buf.getvalue())
-        resp.mimetype = 'image/%s' % format
-        return resp
+        if etag in request.if_none_match:
+            return set_cache_headers(Response(status=304))
+        if static_root is not None:
+            # Prefer tiles pre-rendered with deepzoom_tile.py --viewer, which
+            # separates words in slugs with '_' rather than '-'
+            static_slug = slug.replace('-', '_')
+            try:
+                return send_from_directory(
+                    static_root,
+                    f'{static_slug}_files/{level}/{col}_{row}.{format}',
+                    max_age=86400,
+                )
+            except NotFound:
+                pass
+        key = (slug, level, col, row, format)
+        data = app.tile_cache.get(key)
+        if data is None:
+            tile = app.slides[slug].get_tile(level, (col, row))
+            transform = app.transforms[slug]
+            if transform is not None:
+                transform(tile)
+            data = encode_tile(tile, format, app.config['DEEPZOOM_TILE_QUALITY'])
+            app.tile_cache.put(key, data)
+        return set_cache_headers(Response(data, mimetype='image/%s' % format))
 
     return app
 
 
+def encode_tile(tile: Image.Image, format: str, quality: int) -> bytes:
+    buf = BytesIO()
+    profile = tile.info.get('icc_profile')
+    if format == 'jpeg' and (profile is None or profile is SRGB_PROFILE_BYTES):
+        if simplejpeg is not None:
+            # simplejpeg wraps libjpeg-turbo's TurboJPEG API and encodes
+            # directly from the pixel array
+            data: bytes = simplejpeg.encode_jpeg(
+                np.asarray(tile), quality=quality, colorsubsampling='420'
+            )
+        else:
+            tile.save(buf, 'jpeg', quality=quality)
+            data = buf.getvalue()
+        if profile is not None:
+            # Splice in the preformatted sRGB profile rather than having
+            # the encoder reformat it for every tile
+            data = _splice_jpeg_segments(data, SRGB_PROFILE_JPEG_SEGMENTS)
+        return data
+    tile.save(buf, format, quality=quality, icc_profile=profile)
+    return buf.getvalue()
+
+
+def _splice_jpeg_segments(data: bytes, segments: bytes) -> bytes:
+    # Insert after the SOI marker and the JFIF APP0 segment, if any
+    pos = 2
+    if data[2:4] == b'\xff\xe0':
+        pos += 2 + int.from_bytes(data[4:6], 'big')
+    return data[:pos] + segments + data[pos:]
+
+
+# LRU cache of encoded tiles, bounded by total size
+class _TileCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._cache: OrderedDict[TileKey, bytes] = OrderedDict()
+        self._size = 0
+
+    def get(self, key: TileKey) -> bytes | None:
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+            return data
+
+    def put(self, key: TileKey, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, old = self._cache.popitem(last=False)
+                self._size -= len(old)
+
+
+_SLUG_RE = re.compile('[^a-z0-9]+')
+
+
 def slugify(text: str) -> str:
     text = normalize('NFKD', text.lower()).encode('ascii', 'ignore').decode()
-    return re.sub('[^a-z0-9]+', '-', text)
+    return _SLUG_RE.sub('-', text)
 
 
-def get_transform(image: AbstractSlide, mode: ColorMode) -> Transform:
+def get_transform(image: AbstractSlide, mode: ColorMode) -> Transform | None:
+    # None if tiles can be served as read
     if image.color_profile is None:
-        return lambda img: None
+        return None
     if mode == 'ignore':
         # drop ICC profile from tiles
         return lambda img: img.info.pop('icc_profile')
     elif mode == 'embed':
         # embed ICC profile in tiles
-        return lambda img: None
+        return None
     elif mode == 'default':
         intent = ImageCms.Intent(ImageCms.getDefaultIntent(image.color_profile))
     elif mode == 'absolute-colorimetric':
@@ -340,13 +531,9 @@ if __name__ == '__main__':
     )
 
     args = parser.parse_args()
-    config = {}
     config_file = args.config
     # Set only those settings specified on the command line
-    for k in dir(args):
-        v = getattr(args, k)
-        if not k.startswith('_') and v is not None:
-            config[k] = v
+    config = {k: v for k, v in vars(args).items() if v is not None}
     app = create_app(config, config_file)
 
     app.run(host=args.host, port=args.port, threaded=True)
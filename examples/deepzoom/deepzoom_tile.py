@@ -28,18 +28,28 @@ import base64
 from collections.abc import Callable
 from io import BytesIO
 import json
-from multiprocessing import JoinableQueue, Process
-import multiprocessing.queues
+import math
+from multiprocessing import Pool
+import multiprocessing.pool
 import os
 from pathlib import Path
 import re
 import shutil
+import struct
 import sys
+import time
 from typing import TYPE_CHECKING, Literal
 from unicodedata import normalize
 import zlib
 
-from PIL import Image, ImageCms
+from PIL import Image, ImageCms, features
+
+try:
+    # Optional faster JPEG encoder
+    import numpy as np  # type: ignore[import-not-found,unused-ignore]
+    import simplejpeg  # type: ignore[import-not-found,import-untyped,unused-ignore]
+except ImportError:
+    simplejpeg = None
 
 if TYPE_CHECKING:
     # Python 3.10+
@@ -59,6 +69,7 @@ from openslide import AbstractSlide, ImageSlide, open_slide
 from openslide.deepzoom import DeepZoomGenerator
 
 VIEWER_SLIDE_NAME = 'slide'
+PROGRESS_INTERVAL = 0.25  # seconds
 
 # Optimized sRGB v2 profile, CC0-1.0 license
 # https://github.com/saucecontrol/Compact-ICC-Profiles/blob/bdd84663/profiles/sRGB-v2-micro.icc
@@ -76,6 +87,7 @@ SRGB_PROFILE_BYTES = zlib.decompress(
     )
 )
 SRGB_PROFILE = ImageCms.getOpenProfile(BytesIO(SRGB_PROFILE_BYTES))
+_SLUG_RE = re.compile('[^a-z0-9]+')
 
 if TYPE_CHECKING:
     ColorMode: TypeAlias = Literal[
@@ -87,60 +99,87 @@ if TYPE_CHECKING:
         'embed',
         'ignore',
     ]
-    TileQueue: TypeAlias = multiprocessing.queues.JoinableQueue[
-        tuple[str | None, int, tuple[int, int], Path] | None
-    ]
+    # The output path is a str rather than a Path, since Paths are much more
+    # expensive to pickle
+    TileRequest: TypeAlias = tuple[str | None, int, tuple[int, int], str]
     Transform: TypeAlias = Callable[[Image.Image], None]
 
 
-class TileWorker(Process):
-    """A child process that generates and writes tiles."""
+class TileWorker:
+    """Generates and writes tiles within a worker process."""
 
     def __init__(
         self,
-        queue: TileQueue,
         slidepath: Path,
+        format: str,
         tile_size: int,
         overlap: int,
         limit_bounds: bool,
         quality: int,
+        optimize: bool,
         color_mode: ColorMode,
     ):
-        Process.__init__(self, name='TileWorker')
-        self.daemon = True
-        self._queue = queue
-        self._slidepath = slidepath
+        self._slide = open_slide(slidepath)
+        self._format = format
         self._tile_size = tile_size
         self._overlap = overlap
         self._limit_bounds = limit_bounds
         self._quality = quality
+        # Pillow's optimize option means something else for PNG
+        self._optimize = optimize and format == 'jpeg'
         self._color_mode = color_mode
-        self._slide: AbstractSlide | None = None
-
-    def run(self) -> None:
-        self._slide = open_slide(self._slidepath)
-        last_associated = None
-        dz, transform = self._get_dz_and_transform()
-        while True:
-            data = self._queue.get()
-            if data is None:
-                self._queue.task_done()
-                break
-            associated, level, address, outfile = data
-            if last_associated != associated:
-                dz, transform = self._get_dz_and_transform(associated)
-                last_associated = associated
-            tile = dz.get_tile(level, address)
+        self._dz_cache: dict[str | None, tuple[DeepZoomGenerator, Transform | None]]
+        self._dz_cache = {}
+        # ICC profile -> preformatted JPEG APP2 segments
+        self._icc_segments: dict[bytes, bytes] = {}
+
+    def write_tile(self, data: TileRequest) -> None:
+        associated, level, address, outfile = data
+        if associated not in self._dz_cache:
+            self._dz_cache[associated] = self._get_dz_and_transform(associated)
+        dz, transform = self._dz_cache[associated]
+        tile = dz.get_tile(level, address)
+        if transform is not None:
             transform(tile)
-            tile.save(
-                outfile, quality=self._quality, icc_profile=tile.info.get('icc_profile')
-            )
-            self._queue.task_done()
+        profile = tile.info.get('icc_profile')
+        # Encode into memory, then write the file with a single write() call
+        # rather than many small ones.  This also avoids leaving a truncated
+        # tile behind if encoding fails.
+        encoded: bytes | memoryview
+        if self._format == 'jpeg':
+            if simplejpeg is not None and not self._optimize:
+                # simplejpeg encodes directly from the pixel array with less
+                # overhead than Pillow
+                encoded = simplejpeg.encode_jpeg(
+                    np.asarray(tile), quality=self._quality, colorsubsampling='420'
+                )
+            else:
+                buf = BytesIO()
+                tile.save(buf, 'jpeg', quality=self._quality, optimize=self._optimize)
+                encoded = buf.getvalue()
+            if profile is not None:
+                # Splice in the preformatted profile rather than having the
+                # encoder reformat it for every tile
+                encoded = _splice_jpeg_segments(
+                    encoded, self._get_icc_segments(profile)
+                )
+        else:
+            buf = BytesIO()
+            tile.save(buf, self._format, icc_profile=profile)
+            encoded = buf.getbuffer()
+        with open(outfile, 'wb') as fh:
+            fh.write(encoded)
+
+    def _get_icc_segments(self, profile: bytes) -> bytes:
+        try:
+            return self._icc_segments[profile]
+        except KeyError:
+            segments = self._icc_segments[profile] = _jpeg_icc_segments(profile)
+            return segments
 
     def _get_dz_and_transform(
         self, associated: str | None = None
-    ) -> tuple[DeepZoomGenerator, Transform]:
-        assert self._slide is not None
+    ) -> tuple[DeepZoomGenerator, Transform | None]:
         if associated is not None:
             image: AbstractSlide = ImageSlide(self._slide.associated_images[associated])
         else:
@@ -150,16 +189,17 @@ class TileWorker(Process):
         )
         return dz, self._get_transform(image)
 
-    def _get_transform(self, image: AbstractSlide) -> Transform:
+    def _get_transform(self, image: AbstractSlide) -> Transform | None:
+        # None if tiles can be written as read
         if image.color_profile is None:
-            return lambda img: None
+            return None
         mode = self._color_mode
         if mode == 'ignore':
             # drop ICC profile from tiles
             return lambda img: img.info.pop('icc_profile')
         elif mode == 'embed':
             # embed ICC profile in tiles
-            return lambda img: None
+            return None
         elif mode == 'default':
             intent = ImageCms.Intent(ImageCms.getDefaultIntent(image.color_profile))
         elif mode == 'absolute-colorimetric':
@@ -191,6 +231,80 @@ class TileWorker(Process):
         return xfrm
 
 
+def _jpeg_icc_segments(profile: bytes) -> bytes:
+    # Split the profile into APP2 marker segments, as Pillow would
+    chunk_size = 65519
+    chunks = [profile[i : i + chunk_size] for i in range(0, len(profile), chunk_size)]
+    return b''.join(
+        b'\xff\xe2'
+        + struct.pack('>H', 16 + len(chunk))
+        + b'ICC_PROFILE\0'
+        + bytes((i + 1, len(chunks)))
+        + chunk
+        for i, chunk in enumerate(chunks)
+    )
+
+
+def _splice_jpeg_segments(data: bytes, segments: bytes) -> bytes:
+    # Insert after the SOI marker and the JFIF APP0 segment, if any
+    pos = 2
+    if data[2:4] == b'\xff\xe0':
+        pos += 2 + int.from_bytes(data[4:6], 'big')
+    return data[:pos] + segments + data[pos:]
+
+
+# The TileWorker for this worker process, created by the pool initializer
+_worker: TileWorker | None = None
+
+
+def _init_worker(
+    slidepath: Path,
+    format: str,
+    tile_size: int,
+    overlap: int,
+    limit_bounds: bool,
+    quality: int,
+    optimize: bool,
+    color_mode: ColorMode,
+) -> None:
+    global _worker
+    _worker = TileWorker(
+        slidepath,
+        format,
+        tile_size,
+        overlap,
+        limit_bounds,
+        quality,
+        optimize,
+        color_mode,
+    )
+
+
+def _write_tile(data: TileRequest) -> None:
+    assert _worker is not None
+    _worker.write_tile(data)
+
+
+def _z_order(cols: int, rows: int) -> list[tuple[int, int]]:
+    """Return all (col, row) addresses in a grid in Morton (Z) order."""
+
+    def spread(v: int) -> int:
+        # Insert a zero bit above each bit of v
+        v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+        v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+        v = (v | (v << 2)) & 0x3333333333333333
+        v = (v | (v << 1)) & 0x5555555555555555
+        return v
+
+    col_keys = [spread(col) for col in range(cols)]
+    row_keys = [spread(row) << 1 for row in range(rows)]
+    return sorted(
+        ((col, row) for row in range(rows) for col in range(cols)),
+        key=lambda address: col_keys[address[0]] | row_keys[address[1]],
+    )
+
+
 class DeepZoomImageTiler:
     """Handles generation of tiles and metadata for a single image."""
 
@@ -200,49 +314,79 @@ class DeepZoomImageTiler:
         basename: Path,
         format: str,
         associated: str | None,
-        queue: TileQueue,
+        pool: multiprocessing.pool.Pool,
+        workers: int,
     ):
         self._dz = dz
         self._basename = basename
         self._format = format
         self._associated = associated
-        self._queue = queue
+        self._pool = pool
+        self._workers = workers
         self._processed = 0
+        self._total = dz.tile_count
+        self._last_report = -math.inf
 
     def run(self) -> None:
         self._write_tiles()
         self._write_dzi()
 
     def _write_tiles(self) -> None:
-        for level in range(self._dz.level_count):
-            tiledir = self._basename.with_name(self._basename.name + '_files') / str(
-                level
-            )
+        associated = self._associated
+        suffix = f'.{self._format}'
+        filesdir = self._basename.with_name(self._basename.name + '_files')
+        for level, (cols, rows) in enumerate(self._dz.level_tiles):
+            tiledir = filesdir / str(level)
             tiledir.mkdir(parents=True, exist_ok=True)
-            cols, rows = self._dz.level_tiles[level]
-            for row in range(rows):
-                for col in range(cols):
-                    tilename = tiledir / f'{col}_{row}.{self._format}'
-                    if not tilename.exists():
-                        self._queue.put((self._associated, level, (col, row), tilename))
-                    self._tile_done()
-
-    def _tile_done(self) -> None:
-        self._processed += 1
-        count, total = self._processed, self._dz.tile_count
-        if count % 100 == 0 or count == total:
+            # List the directory once rather than checking each tile
+            with os.scandir(tiledir) as it:
+                existing = {entry.name for entry in it if entry.name.endswith(suffix)}
+            if len(existing) == cols * rows:
+                # Level was completed by a previous run
+                self._tile_done(cols * rows)
+                continue
+            # Build the level's work list in one pass and account for the
+            # existing tiles in bulk.  Z-order keeps each batch of tiles
+            # spatially compact, so a worker's tiles share source tiles in
+            # OpenSlide's cache.
+            prefix = f'{tiledir}{os.sep}'
+            tiles: list[TileRequest] = [
+                (associated, level, (col, row), f'{prefix}{filename}')
+                for col, row in _z_order(cols, rows)
+                if (filename := f'{col}_{row}{suffix}') not in existing
+            ]
+            self._tile_done(cols * rows - len(tiles))
+            # Send tiles to workers in batches to reduce IPC overhead, but
+            # keep batches small enough to spread the level across workers
+            chunksize = max(1, min(64, len(tiles) // (4 * self._workers)))
+            for _ in self._pool.imap_unordered(_write_tile, tiles, chunksize):
+                self._tile_done()
+
+    def _tile_done(self, count: int = 1) -> None:
+        if not count:
+            # Nothing to report, e.g. no existing tiles on a fresh run
+            return
+        self._processed += count
+        processed, total = self._processed, self._total
+        now = time.monotonic()
+        # Limit progress updates to a few per second
+        if now - self._last_report >= PROGRESS_INTERVAL or processed == total:
+            self._last_report = now
             print(
                 "Tiling %s: wrote %d/%d tiles"
-                % (self._associated or 'slide', count, total),
+                % (self._associated or 'slide', processed, total),
                 end='\r',
                 file=sys.stderr,
             )
-            if count == total:
+            if processed == total:
                 print(file=sys.stderr)
 
     def _write_dzi(self) -> None:
-        with self._basename.with_name(self._basename.name + '.dzi').open('w') as fh:
-            fh.write(self.get_dzi())
+        # get_dzi() declares UTF-8 encoding; write the bytes directly rather
+        # than going through the locale-dependent text layer
+        self._basename.with_name(self._basename.name + '.dzi').write_bytes(
+            self.get_dzi().encode('UTF-8')
+        )
 
     def get_dzi(self) -> str:
         return self._dz.get_dzi(self._format)
@@ -260,6 +404,7 @@ class DeepZoomStaticTiler:
         overlap: int,
         limit_bounds: bool,
         quality: int,
+        optimize: bool,
         color_mode: ColorMode,
         workers: int,
         with_viewer: bool,
@@ -273,21 +418,24 @@ class DeepZoomStaticTiler:
         self._tile_size = tile_size
         self._overlap = overlap
         self._limit_bounds = limit_bounds
-        self._queue: TileQueue = JoinableQueue(2 * workers)
         self._workers = workers
         self._color_mode = color_mode
         self._with_viewer = with_viewer
         self._dzi_data: dict[str, str] = {}
-        for _i in range(workers):
-            TileWorker(
-                self._queue,
+        self._pool = Pool(
+            workers,
+            _init_worker,
+            (
                 slidepath,
+                format,
                 tile_size,
                 overlap,
                 limit_bounds,
                 quality,
+                optimize,
                 color_mode,
-            ).start()
+            ),
+        )
 
     def run(self) -> None:
         self._run_image()
@@ -312,7 +460,9 @@ class DeepZoomStaticTiler:
         dz = DeepZoomGenerator(
             image, self._tile_size, self._overlap, limit_bounds=self._limit_bounds
         )
-        tiler = DeepZoomImageTiler(dz, basename, self._format, associated, self._queue)
+        tiler = DeepZoomImageTiler(
+            dz, basename, self._format, associated, self._pool, self._workers
+        )
         tiler.run()
         self._dzi_data[self._url_for(associated)] = tiler.get_dzi()
 
@@ -366,19 +516,19 @@ class DeepZoomStaticTiler:
 
     def _copydir(self, src: Path, dest: Path) -> None:
         dest.mkdir(parents=True, exist_ok=True)
-        for srcpath in src.iterdir():
-            if srcpath.is_file():
-                shutil.copy(srcpath, dest / srcpath.name)
+        with os.scandir(src) as it:
+            for entry in it:
+                if entry.is_file():
+                    shutil.copyfile(entry.path, dest / entry.name)
 
     @classmethod
     def _slugify(cls, text: str) -> str:
         text = normalize('NFKD', text.lower()).encode('ascii', 'ignore').decode()
-        return re.sub('[^a-z0-9]+', '_', text)
+        return _SLUG_RE.sub('_', text)
 
     def _shutdown(self) -> None:
-        for _i in range(self._workers):
-            self._queue.put(None)
-        self._queue.join()
+        self._pool.close()
+        self._pool.join()
 
 
 if __name__ == '__main__':
@@ -466,6 +616,12 @@ if __name__ == '__main__':
         default=90,
         help='JPEG compression quality [90]',
     )
+    parser.add_argument(
+        '--jpeg-optimize',
+        dest='optimize',
+        action='store_true',
+        help='optimize JPEG Huffman tables (smaller but slower)',
+    )
     parser.add_argument(
         '-r',
         '--viewer',
@@ -492,6 +648,13 @@ if __name__ == '__main__':
     args = parser.parse_args()
     if args.basename is None:
         args.basename = Path(args.slidepath.stem)
+    # JPEG encoding dominates tiling time; it's much slower without
+    # libjpeg-turbo's SIMD code
+    if args.format == 'jpeg' and not features.check_feature('libjpeg_turbo'):
+        print(
+            'Warning: Pillow was built without libjpeg-turbo; tiling will be slow',
+            file=sys.stderr,
+        )
 
     DeepZoomStaticTiler(
         args.slidepath,
@@ -501,6 +664,7 @@ if __name__ == '__main__':
         args.overlap,
         args.limit_bounds,
         args.quality,
+        args.optimize,
         args.color_mode,
         args.workers,
         args.with_viewer,
@@ -205,8 +205,20 @@ class OpenSlide(AbstractSlide):
         AbstractSlide.__init__(self)
         self._filename = filename
         self._osr = lowlevel.open(filename)
+        # Levels can't change while the slide is open
+        count = lowlevel.get_level_count(self._osr)
+        self._level_dimensions = tuple(
+            lowlevel.get_level_dimensions(self._osr, i) for i in range(count)
+        )
+        self._level_downsamples = tuple(
+            lowlevel.get_level_downsample(self._osr, i) for i in range(count)
+        )
         if lowlevel.read_icc_profile.available:
             self._profile = lowlevel.read_icc_profile(self._osr)
+        # Share the maps between accesses so their name lists are only
+        # fetched once
+        self._properties = _PropertyMap(self._osr)
+        self._associated_images = _AssociatedImageMap(self._osr, self._profile)
 
     def __repr__(self) -> str:
         return f'{self.__class__.__name__}({self._filename!r})'
@@ -222,6 +234,10 @@ class OpenSlide(AbstractSlide):
         """Close the OpenSlide object."""
         lowlevel.close(self._osr)
 
+    def _check_open(self) -> None:
+        # Raises if the slide is closed or has a latched error
+        lowlevel.get_level_count(self._osr)
+
     @property
     def level_count(self) -> int:
         """The number of levels in the image."""
@@ -232,25 +248,25 @@ class OpenSlide(AbstractSlide):
         """A tuple of (width, height) tuples, one for each level of the image.
 
         level_dimensions[n] contains the dimensions of level n."""
-        return tuple(
-            lowlevel.get_level_dimensions(self._osr, i) for i in range(self.level_count)
-        )
+        # Keep raising on closed or failed slides despite the cached value
+        self._check_open()
+        return self._level_dimensions
 
     @property
     def level_downsamples(self) -> tuple[float, ...]:
         """A tuple of downsampling factors for each level of the image.
 
         level_downsample[n] contains the downsample factor of level n."""
-        return tuple(
-            lowlevel.get_level_downsample(self._osr, i) for i in range(self.level_count)
-        )
+        # Keep raising on closed or failed slides despite the cached value
+        self._check_open()
+        return self._level_downsamples
 
     @property
     def properties(self) -> Mapping[str, str]:
         """Metadata about the image.
 
         This is a map: property name -> property value."""
-        return _PropertyMap(self._osr)
+        return self._properties
 
     @property
     def associated_images(self) -> Mapping[str, Image.Image]:
@@ -260,7 +276,7 @@ class OpenSlide(AbstractSlide):
 
         Unlike in the C interface, the images accessible via this property
         are not premultiplied."""
-        return _AssociatedImageMap(self._osr, self._profile)
+        return self._associated_images
 
     def get_best_level_for_downsample(self, downsample: float) -> int:
         """Return the best level for displaying the given downsample."""
@@ -301,6 +317,7 @@ class OpenSlide(AbstractSlide):
 class _OpenSlideMap(Mapping[str, _T]):
     def __init__(self, osr: lowlevel._OpenSlide):
         self._osr = osr
+        self._names: list[str] | None = None
 
     def __repr__(self) -> str:
         return f'<{self.__class__.__name__} {dict(self)!r}>'
@@ -311,14 +328,23 @@ class _OpenSlideMap(Mapping[str, _T]):
     def __iter__(self) -> Iterator[str]:
         return iter(self._keys())
 
-    @abstractmethod
     def _keys(self) -> list[str]:
         # Private method; always returns list.
+        # The names can't change while the slide is open, so fetch them once.
+        if self._names is None:
+            self._names = self._read_keys()
+        else:
+            # Keep raising on closed or failed slides despite the cached names
+            lowlevel.get_level_count(self._osr)
+        return self._names
+
+    @abstractmethod
+    def _read_keys(self) -> list[str]:
         raise NotImplementedError()
 
 
 class _PropertyMap(_OpenSlideMap[str]):
-    def _keys(self) -> list[str]:
+    def _read_keys(self) -> list[str]:
         return lowlevel.get_property_names(self._osr)
 
     def __getitem__(self, key: str) -> str:
@@ -333,7 +359,7 @@ class _AssociatedImageMap(_OpenSlideMap[Image.Image]):
         _OpenSlideMap.__init__(self, osr)
         self._profile = profile
 
-    def _keys(self) -> list[str]:
+    def _read_keys(self) -> list[str]:
         return lowlevel.get_associated_image_names(self._osr)
 
     def __getitem__(self, key: str) -> Image.Image:
@@ -460,29 +486,34 @@ class ImageSlide(AbstractSlide):
             raise ValueError('Cannot read from a closed slide')
         if level != 0:
             raise OpenSlideError("Invalid level")
-        if ['fail' for s in size if s < 0]:
+        x, y = location
+        w, h = size
+        if w < 0 or h < 0:
             raise OpenSlideError(f"Size {size} must be non-negative")
+        image_w, image_h = self._image.size
+        if x >= 0 and y >= 0 and x + w <= image_w and y + h <= image_h:
+            # Common case: the region is entirely within the image
+            tile = self._image.crop((x, y, x + w, y + h))
+            if tile.mode != 'RGBA':
+                tile = tile.convert('RGBA')
+            # Don't pass through the source image's metadata
+            tile.info.clear()
+            if self._profile is not None:
+                tile.info['icc_profile'] = self._profile
+            return tile
         # Any corner of the requested region may be outside the bounds of
         # the image.  Create a transparent tile of the correct size and
         # paste the valid part of the region into the correct location.
-        image_topleft = [
-            max(0, min(l, limit - 1)) for l, limit in zip(location, self._image.size)
-        ]
-        image_bottomright = [
-            max(0, min(l + s - 1, limit - 1))
-            for l, s, limit in zip(location, size, self._image.size)
-        ]
+        left = max(0, min(x, image_w - 1))
+        top = max(0, min(y, image_h - 1))
+        right = max(0, min(x + w - 1, image_w - 1))
+        bottom = max(0, min(y + h - 1, image_h - 1))
         tile = Image.new("RGBA", size, (0,) * 4)
-        if not [
-            'fail' for tl, br in zip(image_topleft, image_bottomright) if br - tl < 0
-        ]:  # "< 0" not a typo
+        if right >= left and bottom >= top:
             # Crop size is greater than zero in both dimensions.
             # PIL thinks the bottom right is the first *excluded* pixel
-            crop_box = tuple(image_topleft + [d + 1 for d in image_bottomright])
-            tile_offset = tuple(il - l for il, l in zip(image_topleft, location))
-            assert len(crop_box) == 4 and len(tile_offset) == 2
-            crop = self._image.crop(crop_box)
-            tile.paste(crop, tile_offset)
+            crop = self._image.crop((left, top, right + 1, bottom + 1))
+            tile.paste(crop, (left - x, top - y))
         if self._profile is not None:
             tile.info['icc_profile'] = self._profile
         return tile
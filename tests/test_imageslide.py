@@ -126,6 +126,12 @@ class TestImage(_Abstract.SlideTest):
             self.osr.read_region((-10, -10), 0, (400, 400)).size, (400, 400)
         )
 
+    def test_read_region_inside(self) -> None:
+        inside = self.osr.read_region((10, 20), 0, (50, 40))
+        padded = self.osr.read_region((-10, -10), 0, (100, 100))
+        self.assertEqual(inside.mode, 'RGBA')
+        self.assertEqual(inside.tobytes(), padded.crop((20, 30, 70, 70)).tobytes())
+
     def test_read_region_size_dimension_zero(self) -> None:
         self.assertEqual(self.osr.read_region((0, 0), 0, (400, 0)).size, (400, 0))
 
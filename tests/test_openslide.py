@@ -106,6 +106,27 @@ class TestSlideWithoutOpening(unittest.TestCase):
             self.assertEqual(osr.level_count, 4)
         self.assertRaises(ArgumentError, lambda: osr.level_count)
 
+    def test_shared_maps_on_closed_handle(self) -> None:
+        osr = OpenSlide(file_path('small.svs'))
+        self.assertEqual(list(osr.associated_images), ['thumbnail'])
+        self.assertGreater(len(osr.properties), 0)
+        self.assertIs(osr.properties, osr.properties)
+        osr.close()
+        self.assertRaises(ArgumentError, lambda: osr.properties['openslide.vendor'])
+        self.assertRaises(ArgumentError, lambda: osr.associated_images['thumbnail'])
+        self.assertRaises(ArgumentError, lambda: len(osr.properties))
+        self.assertRaises(ArgumentError, lambda: list(osr.properties))
+        self.assertRaises(ArgumentError, lambda: len(osr.associated_images))
+        self.assertRaises(ArgumentError, lambda: list(osr.associated_images))
+
+    def test_cached_metadata_on_closed_handle(self) -> None:
+        osr = OpenSlide(file_path('boxes.tiff'))
+        self.assertEqual(len(osr.level_dimensions), 4)
+        self.assertEqual(len(osr.level_downsamples), 4)
+        osr.close()
+        self.assertRaises(ArgumentError, lambda: osr.level_dimensions)
+        self.assertRaises(ArgumentError, lambda: osr.level_downsamples)
+
 
 class _Abstract:
     # nested class to prevent the test runner from finding it